@@ -1,7 +1,14 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import html
+import itertools
+from collections import Counter, namedtuple
 from datetime import datetime, time
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
+from streamlit.connections import BaseConnection
 
 # --- CONFIGURACIÓN INICIAL Y GESTIÓN DE DATOS ---
 
@@ -11,60 +18,201 @@ SAFE_COLOR_PALETTE = [
     "#e377c2", "#7f7f7f", "#bcbd22", "#17becf", "#4A90E2"
 ]
 
-def get_color_for_pilot(pilot_name, pilot_list):
-    """Asigna un color consistente a un piloto de una lista."""
-    if pilot_name == "Sin Asignar" or not pilot_name:
-        return "#f0f2f6"
-    try:
-        index = pilot_list.index(pilot_name)
-        return SAFE_COLOR_PALETTE[index % len(SAFE_COLOR_PALETTE)]
-    except (ValueError, IndexError):
-        return SAFE_COLOR_PALETTE[hash(pilot_name) % len(SAFE_COLOR_PALETTE)]
+def build_pilot_color_map(pilot_list, extra_pilots=()):
+    """Precalcula un color consistente para cada piloto, para consultarlo sin recorrer la lista."""
+    pilot_color_map = {pilot: SAFE_COLOR_PALETTE[i % len(SAFE_COLOR_PALETTE)] for i, pilot in enumerate(pilot_list)}
+    for pilot in extra_pilots:
+        if pilot and pilot not in pilot_color_map:
+            pilot_color_map[pilot] = SAFE_COLOR_PALETTE[hash(pilot) % len(SAFE_COLOR_PALETTE)]
+    pilot_color_map.pop("Sin Asignar", None)
+    return pilot_color_map
+
+# Tabla de pilotos como arrays contiguos: una entrada por piloto, 'avail' es (pilotos x horas)
+PilotsSoA = namedtuple('PilotsSoA', 'pilots limits starts ends avail')
+
+def build_pilots_soa(pilots_df, hour_cols):
+    """Convierte la tabla editada de pilotos en arrays de numpy; las celdas vacías cuentan como no disponibles."""
+    return PilotsSoA(
+        pilots=pilots_df['Piloto'].to_numpy(),
+        limits=pilots_df['Horas Límite (Opcional)'].to_numpy(dtype=float, na_value=0),
+        starts=(pilots_df['Quiere Empezar'] == True).to_numpy(),
+        ends=(pilots_df['Quiere Terminar'] == True).to_numpy(),
+        avail=(pilots_df.reindex(columns=list(hour_cols)) == True).to_numpy()
+    )
 
 def get_default_team_structure(team_name="Equipo por Defecto", duration=24):
     """Crea la estructura de datos para un nuevo equipo con duración variable."""
     return {
         "race_config": {"start_hour": 14, "duration": duration},
-        "pilots": pd.DataFrame({
-            'Piloto': ['Piloto 1', 'Piloto 2', 'Piloto 3', 'Piloto 4'],
-            'Quiere Empezar': [False, True, False, False],
-            'Quiere Terminar': [False, False, True, False],
-            'Horas Límite (Opcional)': [0, 0, 0, 0],
-            **{str(h): [True] * 4 for h in range(duration)}
-        }).to_dict('records'),
-        "horario": pd.DataFrame({
-            "Piloto al Volante": ["Sin Asignar"] * duration,
-            "Comentarios": [""] * duration
-        }).to_dict('records')
+        "pilots": [
+            {
+                'Piloto': f'Piloto {i + 1}',
+                'Quiere Empezar': i == 1,
+                'Quiere Terminar': i == 2,
+                'Horas Límite (Opcional)': 0,
+                **{str(h): True for h in range(duration)}
+            }
+            for i in range(4)
+        ],
+        "horario": [{"Piloto al Volante": "Sin Asignar", "Comentarios": ""} for _ in range(duration)]
     }
 
+def hour_labels(start_hour, duration):
+    """Etiquetas de hora de inicio y de rango de cada stint, construidas una sola vez por ejecución."""
+    return (
+        tuple(f"{(start_hour + h) % 24:02d}:00" for h in range(duration)),
+        tuple(f"{(start_hour + h) % 24:02d}:00 - {(start_hour + h + 1) % 24:02d}:00" for h in range(duration))
+    )
+
 # --- FUNCIONES DE CARGA Y GUARDADO PARA MONGODB ---
+TEAM_DELETED_ERROR = "Este equipo ya no existe; puede que otra sesión lo haya eliminado. Selecciona otro equipo."
+
+def is_valid_team_name(team_name):
+    """El nombre se usa como ruta de campo en MongoDB: no puede contener '.' ni empezar por '$'."""
+    return bool(team_name) and "." not in team_name and not team_name.startswith("$")
+
+def apply_team_patch(team, patch):
+    """Aplica en memoria un parche con rutas como 'horario.3.Piloto al Volante'."""
+    for path, value in patch.items():
+        *parents, last = path.split(".")
+        target = team
+        for key in parents:
+            target = target[int(key)] if isinstance(target, list) else target.setdefault(key, {})
+        if isinstance(target, list):
+            target[int(last)] = value
+        else:
+            target[last] = value
+
+class MongoConnection(BaseConnection[MongoClient]):
+    """Conexión a MongoDB que lee y escribe solo el equipo necesario."""
+
+    def _connect(self, **kwargs):
+        return MongoClient(**st.secrets["mongo"])
+
+    @property
+    def collection(self):
+        return self._instance.iracing_dashboard_db.teams_data
+
+    def load_data(self):
+        """Lee el documento principal y lo crea con el equipo por defecto si no existe, en una sola operación."""
+        stored_data = self.collection.find_one_and_update(
+            {"_id": "main_database"},
+            {"$setOnInsert": {"data": {"Equipo por Defecto": get_default_team_structure()}}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+            projection={"data": 1}
+        )
+        return stored_data["data"]
+
+    def get_team_keys(self):
+        """Devuelve solo los nombres de los equipos, sin traer sus pilotos ni horarios."""
+        result = list(self.collection.aggregate([
+            {"$match": {"_id": "main_database"}},
+            {"$project": {"names": {"$map": {"input": {"$objectToArray": "$data"}, "as": "t", "in": "$$t.k"}}}}
+        ]))
+        if not result:
+            return list(self.load_data().keys())
+        return result[0]["names"]
+
+    def get_team(self, team_name):
+        """Trae de MongoDB únicamente el subdocumento del equipo indicado, o None si ya no existe."""
+        if not is_valid_team_name(team_name):
+            return self.load_data().get(team_name)
+        stored_data = self.collection.find_one({"_id": "main_database"}, {f"data.{team_name}": 1})
+        if stored_data is None:
+            return self.load_data().get(team_name)
+        return stored_data.get("data", {}).get(team_name)
+
+    def _save_all(self, data):
+        # Equipos antiguos cuyo nombre no sirve como ruta de campo: se reescribe el documento completo
+        self.collection.update_one({"_id": "main_database"}, {"$set": {"data": data}})
+
+    def create_team(self, team_name, team_data):
+        """Crea el equipo de forma atómica; devuelve False si ya existía (p. ej. creado por otra sesión)."""
+        result = self.collection.update_one(
+            {"_id": "main_database", f"data.{team_name}": {"$exists": False}},
+            {"$set": {f"data.{team_name}": team_data}}
+        )
+        return result.matched_count > 0
+
+    def update_team(self, team_name, patch):
+        """Actualiza solo los campos indicados del equipo; devuelve False si el equipo ya no existe."""
+        if not is_valid_team_name(team_name):
+            data = self.load_data()
+            if team_name not in data:
+                return False
+            apply_team_patch(data[team_name], patch)
+            self._save_all(data)
+            return True
+        # Sin el filtro $exists, MongoDB recrearía un equipo eliminado solo con los campos del parche
+        result = self.collection.update_one(
+            {"_id": "main_database", f"data.{team_name}": {"$exists": True}},
+            {"$set": {f"data.{team_name}.{field}": value for field, value in patch.items()}}
+        )
+        return result.matched_count > 0
+
+    def delete_team(self, team_name):
+        if not is_valid_team_name(team_name):
+            data = self.load_data()
+            data.pop(team_name, None)
+            self._save_all(data)
+            return
+        self.collection.update_one({"_id": "main_database"}, {"$unset": {f"data.{team_name}": ""}})
+
+@st.cache_data(ttl=60)
+def list_teams(_conn, version):
+    """Nombres de los equipos para el selector. 'version' se incrementa al crear o eliminar equipos."""
+    return _conn.get_team_keys()
+
+@st.cache_data(ttl=60)
+def load_team(_conn, team_name, version):
+    """Carga los datos de un equipo. 'version' forma parte de la clave de caché para invalidarla al guardar."""
+    return _conn.get_team(team_name)
+
+@st.cache_data(ttl=60)
+def build_pilots_df(team_name, version, _pilots):
+    """Construye el DataFrame de pilotos una sola vez por versión del equipo."""
+    return pd.DataFrame(_pilots)
+
+@st.cache_data(max_entries=64)
+def build_horario_csv(horas_reales, asignaciones, comentarios):
+    """Genera el CSV del horario; solo se vuelve a serializar cuando cambia su contenido."""
+    table = pa.table({
+        "Hora del Stint": list(horas_reales),
+        "Piloto al Volante": list(asignaciones),
+        "Comentarios": list(comentarios)
+    })
+    buf = pa.BufferOutputStream()
+    # PyArrow entrecomilla la cabecera y todas las celdas de texto; el contenido leído es el mismo
+    pa_csv.write_csv(table, buf)
+    return buf.getvalue().to_pybytes()
+
 @st.cache_resource
-def init_connection():
-    return MongoClient(**st.secrets["mongo"])
-
-def load_data(_client):
-    db = _client.iracing_dashboard_db
-    collection = db.teams_data
-    stored_data = collection.find_one({"_id": "main_database"})
-    if stored_data is None:
-        default_data = {"Equipo por Defecto": get_default_team_structure()}
-        collection.insert_one({"_id": "main_database", "data": default_data})
-        return default_data
-    return stored_data["data"]
-
-def save_data(_client, data):
-    db = _client.iracing_dashboard_db
-    collection = db.teams_data
-    collection.update_one({"_id": "main_database"}, {"$set": {"data": data}}, upsert=True)
+def get_cache_versions():
+    """Versiones de caché compartidas por todas las sesiones; el contador global nunca repite un valor."""
+    return {"counter": itertools.count(1), "team": {}, "teams": 0}
+
+def get_team_version(team_name):
+    return get_cache_versions()["team"].get(team_name, 0)
+
+def get_teams_version():
+    return get_cache_versions()["teams"]
+
+def bump_teams_version():
+    """Invalida la lista de equipos tras crear o eliminar uno. Llamar siempre después de escribir en MongoDB."""
+    versions = get_cache_versions()
+    versions["teams"] = next(versions["counter"])
+
+def bump_team_version(team_name):
+    """Invalida la caché del equipo indicado sin afectar a los demás. Llamar siempre después de escribir en MongoDB."""
+    versions = get_cache_versions()
+    versions["team"][team_name] = next(versions["counter"])
 
 # --- INICIALIZACIÓN DE LA APP ---
 st.set_page_config(layout="wide", page_title="Stints iRacing")
 
 # CONECTAR A MONGODB Y CARGAR DATOS
-client = init_connection()
-if 'db' not in st.session_state:
-    st.session_state.db = load_data(client)
+conn = st.connection("mongo", type=MongoConnection)
 
 # --- CONTENIDO PRINCIPAL ---
 st.markdown("<h1 style='text-align: center;'>🏁 iRacing Endurance Stints</h1>", unsafe_allow_html=True)
@@ -75,7 +223,7 @@ if 'newly_created_team' in st.session_state:
     st.session_state.selected_team = st.session_state.newly_created_team
     del st.session_state.newly_created_team
 
-team_names = list(st.session_state.db.keys())
+team_names = list_teams(conn, get_teams_version())
 # Inicializa selected_team en None si no hay una selección válida
 if 'selected_team' not in st.session_state or st.session_state.selected_team not in team_names:
     st.session_state.selected_team = None
@@ -102,26 +250,29 @@ with mid_col_top:
                 key="new_team_duration"
             )
             if st.button("➕ Crear Equipo"):
-                if new_team_name and new_team_name not in st.session_state.db:
-                    st.session_state.db[new_team_name] = get_default_team_structure(
+                if new_team_name and not is_valid_team_name(new_team_name):
+                    st.error("El nombre del equipo no puede contener '.' ni empezar por '$'.")
+                elif new_team_name and new_team_name not in team_names:
+                    created = conn.create_team(new_team_name, get_default_team_structure(
                         team_name=new_team_name,
                         duration=new_team_duration
-                    )
-                    save_data(client, st.session_state.db)
-                    # Actualizamos el estado de la sesión para reflejar el nuevo equipo
-                    st.session_state.db = load_data(client)
-                    st.session_state.newly_created_team = new_team_name
-                    st.rerun()
+                    ))
+                    bump_teams_version()
+                    if created:
+                        bump_team_version(new_team_name)
+                        st.session_state.newly_created_team = new_team_name
+                        st.rerun()
+                    else:
+                        st.error("Ya existe un equipo con ese nombre.")
                 else:
                     st.error("El nombre del equipo no puede estar vacío o ya existe.")
         with col2:
             team_to_delete = st.selectbox("Selecciona equipo a eliminar", options=team_names, index=None, placeholder="Seleccionar...")
             if st.button("❌ Eliminar Equipo Seleccionado", type="primary"):
-                if team_to_delete and len(st.session_state.db) > 1:
-                    del st.session_state.db[team_to_delete]
-                    save_data(client, st.session_state.db)
-                    # Actualizamos el estado de la sesión para reflejar la eliminación
-                    st.session_state.db = load_data(client)
+                if team_to_delete and len(team_names) > 1:
+                    conn.delete_team(team_to_delete)
+                    bump_team_version(team_to_delete)
+                    bump_teams_version()
                     st.session_state.selected_team = None # Deseleccionamos el equipo eliminado
                     st.rerun()
                 else:
@@ -135,11 +286,17 @@ if not st.session_state.selected_team:
     st.stop()
 
 # A partir de aquí, todo el código asume que st.session_state.selected_team tiene un valor
-team_data = st.session_state.db[st.session_state.selected_team]
-config_df = pd.DataFrame(team_data['pilots'])
-horario_df = pd.DataFrame(team_data['horario'])
-if "Comentarios" not in horario_df.columns:
-    horario_df["Comentarios"] = ""
+team_version = get_team_version(st.session_state.selected_team)
+team_data = load_team(conn, st.session_state.selected_team, team_version)
+if team_data is None:
+    # Otra sesión eliminó el equipo y la lista en caché aún lo mostraba: se refresca la lista
+    # y, en el siguiente rerun, selected_team se reinicia al no estar en team_names
+    bump_teams_version()
+    st.rerun()
+config_df = build_pilots_df(st.session_state.selected_team, team_version, team_data['pilots'])
+horario = team_data['horario']
+for fila in horario:
+    fila.setdefault("Comentarios", "")
 
 # --- CONFIGURACIÓN DE CARRERA (HORA Y DURACIÓN) ---
 race_config = team_data.setdefault('race_config', {'start_hour': 14, 'duration': 24})
@@ -166,13 +323,17 @@ with mid_col:
     )
 
 # --- LÓGICA DE ACTUALIZACIÓN DE CONFIGURACIÓN DE CARRERA ---
-config_changed = False
+config_diff = {}
 if new_start_time.hour != start_hour:
     team_data['race_config']['start_hour'] = new_start_time.hour
-    config_changed = True
-
-if config_changed:
-    save_data(client, st.session_state.db)
+    config_diff['race_config.start_hour'] = new_start_time.hour
+
+if config_diff:
+    if not conn.update_team(st.session_state.selected_team, config_diff):
+        bump_teams_version()
+        st.error(TEAM_DELETED_ERROR)
+        st.stop()
+    bump_team_version(st.session_state.selected_team)
     st.rerun()
 
 # --- EXPANSORES CON LAS TABLAS ---
@@ -180,14 +341,14 @@ with st.expander("1. Configuración de Disponibilidad de Pilotos", expanded=True
     st.write("🎨 **Leyenda de Colores:**")
     cols = st.columns(len(pilot_list) if pilot_list else 1)
     for i, pilot in enumerate(pilot_list):
-        color = get_color_for_pilot(pilot, pilot_list)
+        color = SAFE_COLOR_PALETTE[i % len(SAFE_COLOR_PALETTE)]
         cols[i].markdown(f"<div style='background-color:{color}; color:white; padding: 5px; border-radius: 5px; text-align: center;'>{pilot}</div>", unsafe_allow_html=True)
     st.markdown("")
     
     st.info("Nota: Todas las horas se muestran en la zona horaria de CDMX (GMT-6).")
 
-    display_config_df = config_df.copy()
-    dynamic_hour_labels = [f"{(start_hour + h) % 24:02d}:00" for h in range(race_duration)]
+    display_config_df = config_df  # build_pilots_df ya devuelve una copia nueva
+    dynamic_hour_labels, horas_reales = hour_labels(start_hour, race_duration)
     column_map = {str(h): dynamic_hour_labels[h] for h in range(race_duration)}
     display_config_df.rename(columns=column_map, inplace=True)
     
@@ -202,128 +363,149 @@ with st.expander("1. Configuración de Disponibilidad de Pilotos", expanded=True
         }
     )
     if st.button("💾 Guardar Configuración de Pilotos"):
-        latest_db_data = load_data(client)
         reverse_column_map = {v: k for k, v in column_map.items()}
         df_to_save = edited_pilots_df.copy()
         df_to_save.rename(columns=reverse_column_map, inplace=True)
         
-        latest_horario = latest_db_data[st.session_state.selected_team]['horario']
-        for i in range(race_duration):
-            piloto_asignado = latest_horario[i]['Piloto al Volante']
-            if piloto_asignado != "Sin Asignar":
-                piloto_config_row = df_to_save[df_to_save['Piloto'] == piloto_asignado]
-                if not piloto_config_row.empty:
-                    disponible = True
-                    if i == 0: disponible = piloto_config_row['Quiere Empezar'].iloc[0]
-                    elif i == race_duration - 1: disponible = piloto_config_row['Quiere Terminar'].iloc[0]
-                    else: disponible = piloto_config_row[str(i)].iloc[0]
-                    
-                    if not disponible:
-                        latest_horario[i]['Piloto al Volante'] = "Sin Asignar"
-
-        latest_db_data[st.session_state.selected_team]['pilots'] = df_to_save.to_dict('records')
-        latest_db_data[st.session_state.selected_team]['horario'] = latest_horario
-        save_data(client, latest_db_data)
-        st.session_state.db = latest_db_data # Actualiza el estado de la sesión con los nuevos datos
-        st.success("Configuración guardada y horario sincronizado.")
-        st.rerun()
-
-st.markdown("---")
-
-col_assign, col_summary = st.columns(2, gap="large")
-
-with col_assign:
-    st.header("2. Asignación de Stints")
-    horas_reales = [f"{(start_hour + h) % 24:02d}:00 - {(start_hour + h + 1) % 24:02d}:00" for h in range(race_duration)]
-    
-    nuevas_asignaciones = []
-    nuevos_comentarios = []
-    for i in range(race_duration):
-        piloto_actual = horario_df.loc[i, "Piloto al Volante"]
-        comentario_actual = horario_df.loc[i, "Comentarios"]
-        
-        pilotos_disponibles = []
-        if i == 0: pilotos_disponibles = edited_pilots_df[edited_pilots_df['Quiere Empezar'] == True]['Piloto'].tolist()
-        elif i == race_duration - 1: pilotos_disponibles = edited_pilots_df[edited_pilots_df['Quiere Terminar'] == True]['Piloto'].tolist()
+        latest_horario = team_data['horario']
+        # Disponibilidad de cada piloto asignado en su hora: fila = piloto asignado, columna = hora
+        assigned = np.array([fila['Piloto al Volante'] for fila in latest_horario[:race_duration]], dtype=object)
+        disp_cols = ['Quiere Empezar'] + [str(h) for h in range(1, race_duration - 1)] + ['Quiere Terminar']
+        avail_matrix = df_to_save.drop_duplicates('Piloto').set_index('Piloto').reindex(index=assigned, columns=disp_cols)
+        # Los pilotos que no están en la configuración quedan como NaN y se consideran disponibles
+        available = avail_matrix.to_numpy()[np.arange(race_duration), np.arange(race_duration)].astype(bool)
+        columnas = df_to_save.columns.tolist()
+        team_data['pilots'] = [dict(zip(columnas, fila)) for fila in df_to_save.values.tolist()]
+        # Solo se envían las filas del horario que hay que liberar, para no pisar cambios de otras sesiones
+        patch = {'pilots': team_data['pilots']}
+        for i in np.flatnonzero(~available & (assigned != "Sin Asignar")):
+            latest_horario[i]['Piloto al Volante'] = "Sin Asignar"
+            patch[f"horario.{i}.Piloto al Volante"] = "Sin Asignar"
+        if conn.update_team(st.session_state.selected_team, patch):
+            bump_team_version(st.session_state.selected_team)
+            st.success("Configuración guardada y horario sincronizado.")
+            st.rerun()
         else:
-            hora_label = dynamic_hour_labels[i]
-            if hora_label in edited_pilots_df.columns:
-                pilotos_disponibles = edited_pilots_df[edited_pilots_df[hora_label] == True]['Piloto'].tolist()
-        
-        lista_pilotos_filtrada = ["Sin Asignar"] + pilotos_disponibles
-        try: default_index = lista_pilotos_filtrada.index(piloto_actual)
-        except ValueError: default_index = 0
+            bump_teams_version()
+            st.error(TEAM_DELETED_ERROR)
 
-        row_cols = st.columns([2, 2, 2, 2])
-        row_cols[0].write(f"**{horas_reales[i]}**")
-        
-        seleccion = row_cols[2].selectbox(f"sel_{i}", options=lista_pilotos_filtrada, index=default_index, label_visibility="collapsed", key=f"piloto_hora_{i}_{st.session_state.selected_team}")
-        nuevas_asignaciones.append(seleccion)
-        comentario = row_cols[3].text_input(f"com_{i}", value=comentario_actual, label_visibility="collapsed", placeholder="Comentarios...", key=f"comentario_hora_{i}_{st.session_state.selected_team}")
-        nuevos_comentarios.append(comentario)
-
-        color = get_color_for_pilot(seleccion, pilot_list)
-        text_color = 'white' if color != '#f0f2f6' else 'black'
-        row_cols[1].markdown(f"<div style='background-color:{color}; color:{text_color}; padding: 8px; border-radius: 5px; text-align: center; margin-top: -8px;'>{seleccion}</div>", unsafe_allow_html=True)
-
-    if st.button("💾 Guardar Horario Asignado", use_container_width=True):
-        latest_db_data = load_data(client)
-        # Obtenemos una copia del horario para modificarla
-        horario_a_guardar = latest_db_data[st.session_state.selected_team]['horario']
-        for i in range(race_duration):
-            # Comparamos con el horario mostrado en la UI (horario_df)
-            if nuevas_asignaciones[i] != horario_df.loc[i, "Piloto al Volante"]:
-                horario_a_guardar[i]['Piloto al Volante'] = nuevas_asignaciones[i]
-            if nuevos_comentarios[i] != horario_df.loc[i, "Comentarios"]:
-                horario_a_guardar[i]['Comentarios'] = nuevos_comentarios[i]
-        
-        latest_db_data[st.session_state.selected_team]['horario'] = horario_a_guardar
-        save_data(client, latest_db_data)
-        st.session_state.db = latest_db_data # Actualiza el estado de la sesión con los nuevos datos
-        st.success("Horario guardado y fusionado correctamente.")
-        st.rerun()
+# Los pilotos añadidos en el editor y aún no guardados también reciben color
+pilot_color_map = build_pilot_color_map(pilot_list, edited_pilots_df['Piloto'].dropna())
+pilots_soa = build_pilots_soa(edited_pilots_df, dynamic_hour_labels)
+
+st.markdown("---")
 
-with col_summary:
+# --- ASIGNACIÓN Y RESUMEN (FRAGMENTO) ---
+def render_summary(nuevas_asignaciones, nuevos_comentarios, horas_reales, pilots_soa, pilot_color_map, selected_team):
+    """Dibuja la columna de resumen a partir de las asignaciones actuales."""
     st.header("3. Resumen del Horario")
-    resumen_df = pd.Series(nuevas_asignaciones).value_counts().drop("Sin Asignar", errors='ignore').reset_index()
-    resumen_df.columns = ['Piloto', 'Número de Stints']
-    
-    st.subheader("📊 Resumen de Stints")
-    def style_pilot_col(col):
-        return col.apply(lambda pilot: f"background-color: {get_color_for_pilot(pilot, pilot_list)}; color: {'white' if get_color_for_pilot(pilot, pilot_list) != '#f0f2f6' else 'black'}")
+    conteo = Counter(nuevas_asignaciones)
+    conteo.pop("Sin Asignar", None)
+    conteo_ordenado = conteo.most_common()
 
-    if not resumen_df.empty:
-        st.dataframe(resumen_df.style.apply(style_pilot_col, subset=['Piloto']), use_container_width=True, hide_index=True)
-    else:
-        st.dataframe(resumen_df, use_container_width=True, hide_index=True)
+    st.subheader("📊 Resumen de Stints")
+    filas_html = "".join(
+        f"<tr><td style='background-color:{pilot_color_map.get(piloto, '#f0f2f6')}; color:{'white' if piloto in pilot_color_map else 'black'}; padding: 6px;'>{html.escape(str(piloto))}</td>"
+        f"<td style='padding: 6px;'>{stints}</td></tr>"
+        for piloto, stints in conteo_ordenado
+    )
+    st.markdown(
+        "<table style='width: 100%;'><thead><tr><th>Piloto</th><th>Número de Stints</th></tr></thead>"
+        f"<tbody>{filas_html}</tbody></table>",
+        unsafe_allow_html=True
+    )
 
     st.subheader("⚠️ Alertas de Límite")
     alertas_mostradas = False
-    for _, row in resumen_df.iterrows():
-        piloto_nombre = row['Piloto']
-        stints_asignados = row['Número de Stints']
-        limite_piloto_df = edited_pilots_df[edited_pilots_df['Piloto'] == piloto_nombre]
-        if not limite_piloto_df.empty:
-            limite = limite_piloto_df['Horas Límite (Opcional)'].iloc[0]
-            if limite > 0 and stints_asignados > limite:
-                st.warning(f"**{piloto_nombre}** supera su límite de {int(limite)} stints ({stints_asignados} asignados).")
-                alertas_mostradas = True
+    # Recorremos al revés para que, con nombres repetidos, prevalezca el primer piloto
+    limite_por_piloto = dict(zip(pilots_soa.pilots[::-1].tolist(), pilots_soa.limits[::-1].tolist()))
+    stints = np.array([n for _, n in conteo_ordenado])
+    limites = np.array([limite_por_piloto.get(piloto, 0) for piloto, _ in conteo_ordenado], dtype=float)
+    mask = (limites > 0) & (stints > limites)
+    for idx in np.flatnonzero(mask):
+        st.warning(f"**{conteo_ordenado[idx][0]}** supera su límite de {int(limites[idx])} stints ({stints[idx]} asignados).")
+        alertas_mostradas = True
     
     if not alertas_mostradas:
         st.success("Todos los pilotos están dentro de sus límites.")
 
     st.subheader("📥 Descargar")
-    df_to_download = pd.DataFrame({
-        "Hora del Stint": horas_reales, 
-        "Piloto al Volante": nuevas_asignaciones,
-        "Comentarios": nuevos_comentarios
-    })
-    csv_data = df_to_download.to_csv(index=False).encode('utf-8')
+    csv_data = build_horario_csv(horas_reales, tuple(nuevas_asignaciones), tuple(nuevos_comentarios))
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     st.download_button(
         label="Descargar Horario en CSV",
         data=csv_data,
-        file_name=f"horario_{st.session_state.selected_team}_{timestamp}.csv",
+        file_name=f"horario_{selected_team}_{timestamp}.csv",
         mime="text/csv",
         use_container_width=True
-    )
\ No newline at end of file
+    )
+
+@st.fragment
+def stint_assignment_fragment(horario, team_data, pilots_soa, pilot_color_map, horas_reales, race_duration, selected_team):
+    """Asignación y resumen del horario; al enviar el formulario solo se vuelve a ejecutar este fragmento."""
+    col_assign, col_summary = st.columns(2, gap="large")
+
+    with col_assign:
+        st.header("2. Asignación de Stints")
+    
+        # Pilotos disponibles por hora, calculados en una sola pasada sobre la tabla de disponibilidad
+        available_by_hour = {h: pilots_soa.pilots[pilots_soa.avail[:, h]].tolist() for h in range(race_duration)}
+        available_by_hour[race_duration - 1] = pilots_soa.pilots[pilots_soa.ends].tolist()
+        available_by_hour[0] = pilots_soa.pilots[pilots_soa.starts].tolist()
+
+        # Columnas del horario guardado, extraídas una sola vez para el bucle y la comparación al guardar
+        pilot_col = [fila["Piloto al Volante"] for fila in horario]
+        com_col = [fila["Comentarios"] for fila in horario]
+
+        # Dentro del formulario los cambios no provocan reruns hasta pulsar guardar
+        with st.form("stints"):
+            nuevas_asignaciones = []
+            nuevos_comentarios = []
+            for i in range(race_duration):
+                piloto_actual = pilot_col[i]
+                comentario_actual = com_col[i]
+        
+                lista_pilotos_filtrada = ["Sin Asignar"] + available_by_hour[i]
+                try: default_index = lista_pilotos_filtrada.index(piloto_actual)
+                except ValueError: default_index = 0
+
+                row_cols = st.columns([2, 2, 2, 2])
+                row_cols[0].write(f"**{horas_reales[i]}**")
+        
+                seleccion = row_cols[2].selectbox(f"sel_{i}", options=lista_pilotos_filtrada, index=default_index, label_visibility="collapsed", key=f"piloto_hora_{i}_{selected_team}")
+                nuevas_asignaciones.append(seleccion)
+                comentario = row_cols[3].text_input(f"com_{i}", value=comentario_actual, label_visibility="collapsed", placeholder="Comentarios...", key=f"comentario_hora_{i}_{selected_team}")
+                nuevos_comentarios.append(comentario)
+
+                color = pilot_color_map.get(seleccion, "#f0f2f6")
+                text_color = 'white' if color != '#f0f2f6' else 'black'
+                row_cols[1].markdown(f"<div style='background-color:{color}; color:{text_color}; padding: 8px; border-radius: 5px; text-align: center; margin-top: -8px;'>{seleccion}</div>", unsafe_allow_html=True)
+
+            submitted = st.form_submit_button("💾 Guardar Horario Asignado", use_container_width=True)
+
+        if submitted:
+            # Solo se envían a MongoDB las filas que cambiaron respecto al horario mostrado
+            horario_a_guardar = team_data['horario']
+            diff = {}
+            for i in range(race_duration):
+                if nuevas_asignaciones[i] != pilot_col[i]:
+                    horario_a_guardar[i]['Piloto al Volante'] = nuevas_asignaciones[i]
+                    diff[f"horario.{i}"] = horario_a_guardar[i]
+                if nuevos_comentarios[i] != com_col[i]:
+                    horario_a_guardar[i]['Comentarios'] = nuevos_comentarios[i]
+                    diff[f"horario.{i}"] = horario_a_guardar[i]
+
+            if not diff:
+                st.toast("No hay cambios que guardar.")
+            elif conn.update_team(selected_team, diff):
+                bump_team_version(selected_team)
+                st.success("Horario guardado y fusionado correctamente.")
+                st.rerun()
+            else:
+                bump_teams_version()
+                st.error(TEAM_DELETED_ERROR)
+
+    with col_summary:
+        render_summary(nuevas_asignaciones, nuevos_comentarios, horas_reales, pilots_soa, pilot_color_map, selected_team)
+
+stint_assignment_fragment(horario, team_data, pilots_soa, pilot_color_map, horas_reales, race_duration, st.session_state.selected_team)